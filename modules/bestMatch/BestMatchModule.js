@@ -6,7 +6,7 @@ const BaseCredentialModule = require('../../core/BaseCredentialModule');
 
 /**
  * BestMatchModule - 智能设备匹配模块
- * 使用轻量TF-IDF + 余弦相似度来匹配意图设备与实体列表
+ * 使用轻量的字符 n-gram + 余弦相似度来匹配意图设备与实体列表
  * 支持多语言（中英文/拼音）、模糊匹配、泛指设备和位置提取
  * 运行环境：Termux Proot Ubuntu（无GPU）
  */
@@ -1,19 +1,34 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-智能设备匹配系统 - TF-IDF + 余弦相似度实现
+智能设备匹配系统 - 字符 n-gram + 余弦相似度实现
 适用于 Termux Proot Ubuntu 环境
 """
 
 import re
 import json
+import math
 import os
 import sys
+import functools
+import heapq
 import requests
-from typing import List, Dict, Any, Tuple
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from collections import defaultdict
+from typing import List, Dict, Any, Tuple, FrozenSet, Optional
+
+# 可选依赖：pyahocorasick 可用时用 Aho-Corasick 自动机提取设备名中的位置
+try:
+    import ahocorasick
+    _HAS_AHOCORASICK = True
+except ImportError:
+    _HAS_AHOCORASICK = False
+
+# 可选依赖：orjson 可用时用于读取输入和输出结果
+try:
+    import orjson
+    _HAS_ORJSON = True
+except ImportError:
+    _HAS_ORJSON = False
 
 # ===================== 配置常量 =====================
 
@@ -102,17 +117,28 @@ HA_DOMAIN_ALIASES = {
 
 # ===================== 文本规范化函数 =====================
 
-def normalize_text(text: str) -> str:
+# 只保留字母、数字、中文
+_STRIP = re.compile(r'[^a-z0-9\u4e00-\u9fa5]')
+
+
+def _as_str(value: Any) -> str:
+    # 实体字段可能是任意 JSON 值（如列表），先转为字符串再进入带缓存的规范化函数
+    return value if type(value) is str else str(value)
+
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_text(text: str) -> str:
+    # 空格、下划线、连字符均不在保留字符集中，一次替换即可全部移除
+    return _STRIP.sub('', text.lower())
+
+
+def normalize_text(text: Any) -> str:
     """
     规范化文本：移除空格、下划线、大小写，只保留字母、数字、中文
     """
     if not text:
         return ""
-    text = str(text).lower()
-    text = re.sub(r'\s+', '', text)  # 移除空格
-    text = re.sub(r'[_-]', '', text)  # 移除下划线和连字符
-    text = re.sub(r'[^a-z0-9\u4e00-\u9fa5]', '', text)  # 只保留字母、数字、中文
-    return text.strip()
+    return _normalize_text(_as_str(text))
 
 
 def fuzzy_match(a: str, b: str) -> bool:
@@ -126,171 +152,213 @@ def fuzzy_match(a: str, b: str) -> bool:
 
 # ===================== 别名规范化函数 =====================
 
-def normalize_floor(input_text: str) -> str:
+def _build_alias_reverse_index(alias_map: Dict[str, List[str]]) -> Dict[str, str]:
     """
-    楼层规范化：将各种表达方式转换为标准楼层编号
+    构建别名反向索引：{规范化别名: 标准值}，先出现的映射优先
     """
-    if not input_text:
-        return ""
-    normalized = normalize_text(input_text)
+    index = {}
+    for canonical, aliases in alias_map.items():
+        for alias in [canonical] + list(aliases):
+            alias_norm = normalize_text(alias)
+            if alias_norm:
+                index.setdefault(alias_norm, canonical)
+    return index
+
+
+# 别名反向索引（模块加载时构建，别名更新时需重建）
+_FLOOR_REV = _build_alias_reverse_index(FLOOR_ALIASES)
+_ROOM_REV = _build_alias_reverse_index(ROOM_ALIASES)
+_DOMAIN_REV = _build_alias_reverse_index(HA_DOMAIN_ALIASES)
+
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_floor(input_text: str) -> str:
+    normalized = _normalize_text(input_text)
 
     # 如果已经是纯数字，直接返回
     if normalized.isdigit():
         return normalized
 
-    # 在别名表中查找
-    for level, aliases in FLOOR_ALIASES.items():
-        if normalized == level:
-            return level
-        for alias in aliases:
-            if normalized == normalize_text(alias):
-                return level
+    return _FLOOR_REV.get(normalized, normalized)
+
 
-    return normalized
+def normalize_floor(input_text: Any) -> str:
+    """
+    楼层规范化：将各种表达方式转换为标准楼层编号
+    """
+    if not input_text:
+        return ""
+    return _normalize_floor(_as_str(input_text))
+
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_room(input_text: str) -> str:
+    normalized = _normalize_text(input_text)
+    return _ROOM_REV.get(normalized, normalized)
 
 
-def normalize_room(input_text: str) -> str:
+def normalize_room(input_text: Any) -> str:
     """
     房间规范化：将各种表达方式转换为标准房间类型
     """
     if not input_text:
         return ""
-    normalized = normalize_text(input_text)
+    return _normalize_room(_as_str(input_text))
 
-    # 在别名表中查找
-    for room_type, aliases in ROOM_ALIASES.items():
-        if normalized == normalize_text(room_type):
-            return room_type
-        for alias in aliases:
-            if normalized == normalize_text(alias):
-                return room_type
 
-    return normalized
+@functools.lru_cache(maxsize=4096)
+def _normalize_domain(input_text: str) -> str:
+    return _DOMAIN_REV.get(_normalize_text(input_text), input_text.lower())
 
 
-def normalize_domain(input_text: str) -> str:
+def normalize_domain(input_text: Any) -> str:
     """
     域规范化：将各种表达方式转换为标准 HA 域
     """
     if not input_text:
         return ""
-    normalized = normalize_text(input_text)
+    return _normalize_domain(_as_str(input_text))
 
-    # 在别名表中查找
-    for domain, aliases in HA_DOMAIN_ALIASES.items():
-        if normalized == normalize_text(domain):
-            return domain
-        for alias in aliases:
-            if normalized == normalize_text(alias):
-                return domain
 
-    return input_text.lower()
+@functools.lru_cache(maxsize=4096)
+def _is_generic_device_name(name: str) -> bool:
+    return _normalize_text(name) in GENERIC_DEVICE_NAMES
 
 
-def is_generic_device_name(name: str) -> bool:
+def is_generic_device_name(name: Any) -> bool:
     """
     判断是否为泛指设备名
     """
     if not name:
         return False
-    return normalize_text(name) in GENERIC_DEVICE_NAMES
+    return _is_generic_device_name(_as_str(name))
 
 
-# ===================== TF-IDF 相似度计算 =====================
+# ===================== 字符 n-gram 相似度计算 =====================
 
-def calculate_tfidf_similarity(query: str, candidates: List[str]) -> List[float]:
+@functools.lru_cache(maxsize=8192)
+def _char_ngrams(text: str, n_range: Tuple[int, int] = (1, 3)) -> FrozenSet[str]:
     """
-    使用 TF-IDF + 余弦相似度计算文本相似度
+    提取字符级 n-gram 集合（带缓存，键为规范化后的文本）
+    """
+    n_lo, n_hi = n_range
+    return frozenset(
+        text[i:i + n]
+        for n in range(n_lo, n_hi + 1)
+        for i in range(len(text) - n + 1)
+    )
 
-    Args:
-        query: 查询文本
-        candidates: 候选文本列表
 
-    Returns:
-        相似度得分列表
+def _ngram_cosine(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    """
+    两个 n-gram 集合的余弦相似度
     """
-    if not query or not candidates:
-        return [0.0] * len(candidates)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / math.sqrt(len(a) * len(b))
 
-    # 过滤空候选
-    valid_candidates = [c if c else "" for c in candidates]
 
-    # 如果所有候选都为空，返回0分
-    if all(not c for c in valid_candidates):
-        return [0.0] * len(candidates)
+def _slot_grams(text: str) -> FrozenSet[str]:
+    """
+    槽位文本的 n-gram 集合（空文本为空集合）
+    """
+    return _char_ngrams(text) if text else frozenset()
 
-    # 准备文本列表：查询 + 所有候选
-    all_texts = [query] + valid_candidates
 
-    try:
-        # 创建 TF-IDF 向量化器（字符级 n-gram，适合中文）
-        vectorizer = TfidfVectorizer(
-            analyzer='char',
-            ngram_range=(1, 3),  # 1-3 字符的 n-gram
-            max_features=1000    # 限制特征数量以提高性能
-        )
+def prepare_slot(*candidates) -> Tuple[Tuple[Any, str, FrozenSet[str]], ...]:
+    """
+    预处理槽位候选：(原始值, 规范化文本, n-gram 表示)，空值被丢弃
 
-        # 计算 TF-IDF 向量
-        tfidf_matrix = vectorizer.fit_transform(all_texts)
+    实体侧的槽位在建索引时处理一次，之后每个设备请求直接复用。
+    """
+    slot = []
+    for cand in candidates:
+        if not cand:
+            continue
+        c = normalize_text(str(cand))
+        slot.append((cand, c, _slot_grams(c)))
+    return tuple(slot)
 
-        # 计算余弦相似度
-        query_vector = tfidf_matrix[0:1]
-        candidate_vectors = tfidf_matrix[1:]
-        similarities = cosine_similarity(query_vector, candidate_vectors)[0]
 
-        return similarities.tolist()
+def prepare_query(query: str) -> Tuple[str, Any]:
+    """
+    预处理查询文本：(规范化文本, n-gram 表示)
 
-    except Exception as e:
-        print(f"TF-IDF 计算错误: {e}", file=sys.stderr)
-        return [0.0] * len(candidates)
+    设备请求的各槽位查询在每个设备上只处理一次，供所有实体复用。
+    """
+    q = normalize_text(query or "")
+    if not q:
+        return q, None
+    return q, _slot_grams(q)
 
 
-def slot_similarity(query: str, *candidates) -> Dict[str, Any]:
+def match_slot(prepared: Tuple[str, Any],
+               slot: Tuple[Tuple[Any, str, Any], ...]) -> Dict[str, Any]:
     """
-    计算查询文本与候选文本的最佳相似度
-
-    Args:
-        query: 查询文本
-        *candidates: 可变数量的候选文本
+    计算已预处理查询（见 prepare_query）与已预处理槽位的最佳相似度
 
     Returns:
         {"score": 最佳得分, "hit": 最佳匹配文本}
     """
-    q = normalize_text(query or "")
-    if not q:
-        return {"score": 0.0, "hit": ""}
-
-    # 过滤有效候选
-    valid_candidates = [c for c in candidates if c]
-    if not valid_candidates:
+    q, q_grams = prepared
+    if not q or not slot:
         return {"score": 0.0, "hit": ""}
 
     # 首先检查完全匹配
-    for cand in valid_candidates:
-        c = normalize_text(str(cand))
-        if not c:
-            continue
-        if q == c:
+    for cand, c, _ in slot:
+        if c and q == c:
             return {"score": 1.0, "hit": cand}
 
-    # 使用 TF-IDF 计算相似度
-    candidate_texts = [normalize_text(str(c)) for c in valid_candidates]
-    similarities = calculate_tfidf_similarity(q, candidate_texts)
-
-    # 找到最佳匹配
-    best_idx = int(np.argmax(similarities))
-    best_score = float(similarities[best_idx])
-    best_hit = valid_candidates[best_idx]
+    # 使用预计算的 n-gram 表示计算余弦相似度，单次遍历找到最佳匹配（并列取第一个）
+    best_score = -1.0
+    best_hit = ""
+    for cand, _, grams in slot:
+        score = _ngram_cosine(q_grams, grams)
+        if score > best_score:
+            best_score = score
+            best_hit = cand
 
     return {"score": best_score, "hit": best_hit}
 
 
 # ===================== 位置提取功能 =====================
 
+def _build_location_matcher(room_aliases: Dict[str, List[str]]) -> Any:
+    """
+    构建房间名称匹配器
+
+    pyahocorasick 可用时返回 Aho-Corasick 自动机（值为 (房间顺序, 房间类型)），
+    否则返回按房间顺序排列的 [(规范化别名, 房间类型), ...] 列表。
+    """
+    patterns = []
+    for order, (room_type, aliases) in enumerate(room_aliases.items()):
+        for alias in [room_type] + list(aliases):
+            alias_norm = normalize_text(alias)
+            if alias_norm:
+                patterns.append((alias_norm, order, room_type))
+
+    if not _HAS_AHOCORASICK:
+        return [(alias_norm, room_type) for alias_norm, _, room_type in patterns]
+
+    automaton = ahocorasick.Automaton()
+    for alias_norm, order, room_type in patterns:
+        # 同一别名属于多个房间时保留靠前的房间
+        if not automaton.exists(alias_norm):
+            automaton.add_word(alias_norm, (order, room_type))
+    automaton.make_automaton()
+    return automaton
+
+
+# 位置匹配器（模块加载时构建，房间别名更新时需重建）
+_LOCATION_MATCHER = _build_location_matcher(ROOM_ALIASES)
+
+
 def extract_location_from_name(device_name: str) -> Tuple[bool, str]:
     """
     从设备名中提取位置信息
 
+    多个房间同时命中时，返回 ROOM_ALIASES 中靠前的房间。
+
     Returns:
         (是否包含位置, 提取的房间类型)
     """
@@ -299,43 +367,249 @@ def extract_location_from_name(device_name: str) -> Tuple[bool, str]:
 
     normalized_name = normalize_text(device_name)
 
-    # 检查是否包含房间名称
-    for room_type, aliases in ROOM_ALIASES.items():
-        # 检查房间类型本身
-        if normalize_text(room_type) in normalized_name:
-            return True, room_type
+    if _HAS_AHOCORASICK:
+        hits = [value for _, value in _LOCATION_MATCHER.iter(normalized_name)]
+        if hits:
+            return True, min(hits)[1]
+        return False, ""
 
-        # 检查所有别名
-        for alias in aliases:
-            if normalize_text(alias) in normalized_name:
-                return True, room_type
+    # 检查是否包含房间名称或别名
+    for alias_norm, room_type in _LOCATION_MATCHER:
+        if alias_norm in normalized_name:
+            return True, room_type
 
     return False, ""
 
 
 # ===================== 核心匹配评分函数 =====================
 
-def score_entity(device: Dict[str, Any], entity: Dict[str, Any]) -> Dict[str, Any]:
+def prepare_device_query(device: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    预计算设备请求侧的查询字段（每个设备只算一次，供所有实体评分复用）
+
+    Args:
+        device: 设备请求（intent中的device对象）
+
+    Returns:
+        查询字段及其规范化结果
+    """
+    # ⭐ 优先使用 _en 字段以提高匹配准确性
+    floor_q = device.get("floor_name_en") or device.get("floor_type") or device.get("floor_name") or ""
+    room_q = device.get("room_name_en") or device.get("room_type") or device.get("room_name") or ""
+    name_q = device.get("device_name_en") or device.get("device_name") or ""
+
+    # service 的域只解析一次（partition 比 split 更轻量）
+    svc_domain = device["service"].partition(".")[0].lower() if device.get("service") else ""
+
+    type_q = (device.get("device_type") or "").lower() or svc_domain
+    norm_type_q = normalize_domain(type_q)
+
+    return {
+        "floor_q": floor_q,
+        "room_q": room_q,
+        "name_q": name_q,
+        "type_q": type_q,
+        "norm_floor_q": normalize_floor(floor_q),
+        "norm_room_q": normalize_room(room_q),
+        "norm_type_q": norm_type_q,
+        # 四个槽位的查询一次性预处理
+        "floor_prepared": prepare_query(floor_q),
+        "room_prepared": prepare_query(room_q),
+        "name_prepared": prepare_query(name_q),
+        "type_prepared": prepare_query(norm_type_q),
+        "extracted_location": extract_location_from_name(name_q)[1] if name_q else "",
+        "is_generic_name": is_generic_device_name(name_q),
+        "svc_domain": svc_domain,
+        "norm_svc_domain": normalize_domain(svc_domain)
+    }
+
+
+def prepare_entity_features(entity: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    预计算实体侧的字段及其规范化结果（与设备请求无关，可跨请求复用）
+
+    评分只读取这里整理好的扁平字段，原始实体仅用于构建输出。
+
+    Args:
+        entity: 实体对象
+
+    Returns:
+        实体字段及其规范化结果
+    """
+    e_type = (entity.get("device_type") or "").lower()
+    e_domain = entity["entity_id"].partition(".")[0] if entity.get("entity_id") else ""
+    norm_e_domain = normalize_domain(e_domain)
+    e_level = str(entity.get("level", "")) if entity.get("level") is not None else ""
+    e_friendly_name = entity.get("attributes", {}).get("friendly_name") or entity.get("friendly_name") or ""
+
+    e_floor_name = entity.get("floor_name") or ""
+    e_floor_name_en = entity.get("floor_name_en") or ""
+    e_floor_type = entity.get("floor_type") or ""
+    e_room_name = entity.get("room_name") or ""
+    e_room_name_en = entity.get("room_name_en") or ""
+    e_room_type = entity.get("room_type") or ""
+
+    return {
+        "e_floor_name": e_floor_name,
+        "e_floor_name_en": e_floor_name_en,
+        "e_floor_type": e_floor_type,
+        "e_level": e_level,
+        "e_room_name": e_room_name,
+        "e_room_name_en": e_room_name_en,
+        "e_room_type": e_room_type,
+        "norm_e_floor_name": normalize_floor(e_floor_name),
+        "norm_e_floor_name_en": normalize_floor(e_floor_name_en),
+        "norm_e_floor_type": normalize_floor(e_floor_type),
+        "norm_e_room_name": normalize_room(e_room_name),
+        "norm_e_room_name_en": normalize_room(e_room_name_en),
+        "norm_e_room_type": normalize_room(e_room_type),
+        "e_type": e_type,
+        "e_domain": e_domain,
+        "norm_e_type": normalize_domain(e_type),
+        "norm_e_domain": norm_e_domain,
+        "text_e_type": normalize_text(e_type),
+        # 各槽位的候选 n-gram，与 score_entity 中的候选顺序一致
+        "floor_slot": prepare_slot(entity.get("floor_name"), entity.get("floor_name_en"),
+                                   entity.get("floor_type"), e_level),
+        "room_slot": prepare_slot(entity.get("room_name"), entity.get("room_name_en"),
+                                  entity.get("room_type")),
+        "name_slot": prepare_slot(entity.get("device_name"), e_friendly_name),
+        "type_slot": prepare_slot(norm_e_domain, e_type)
+    }
+
+
+# 实体索引缓存：{实体列表指纹: 特征列表}，实体列表在多次匹配间通常不变
+_ENTITY_INDEX_CACHE: Dict[Any, List[Dict[str, Any]]] = {}
+_ENTITY_INDEX_CACHE_SIZE = 8
+
+_FINGERPRINT_FIELDS = (
+    "entity_id", "device_type", "device_name", "friendly_name",
+    "floor_name", "floor_name_en", "floor_type", "level",
+    "room_name", "room_name_en", "room_type"
+)
+
+
+def build_entity_index(entities: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    构建（或从缓存读取）与实体列表一一对应的特征列表
+
+    Args:
+        entities: 实体列表
+
+    Returns:
+        每个实体的 prepare_entity_features 结果
+    """
+    key = tuple(
+        tuple(e.get(f) for f in _FINGERPRINT_FIELDS) +
+        ((e.get("attributes") or {}).get("friendly_name"),)
+        for e in entities
+    )
+    try:
+        cached = _ENTITY_INDEX_CACHE.get(key)
+    except TypeError:
+        # 字段值不可哈希（如列表）时指纹无法作为键，本次不缓存；
+        # 特征计算不受影响，规范化函数会先把这类值转为字符串
+        key, cached = None, None
+
+    if cached is not None:
+        return cached
+
+    index = [prepare_entity_features(e) for e in entities]
+
+    if key is not None:
+        if len(_ENTITY_INDEX_CACHE) >= _ENTITY_INDEX_CACHE_SIZE:
+            _ENTITY_INDEX_CACHE.pop(next(iter(_ENTITY_INDEX_CACHE)))
+        _ENTITY_INDEX_CACHE[key] = index
+
+    return index
+
+
+def build_type_buckets(entity_index: List[Dict[str, Any]]) -> Dict[str, Dict[str, List[int]]]:
+    """
+    按实体类型/域构建倒排索引：{特征名: {取值: [实体下标, ...]}}
+
+    Args:
+        entity_index: build_entity_index 的结果
+
+    Returns:
+        norm_e_type / text_e_type / norm_e_domain 三个倒排表
+    """
+    buckets = {key: defaultdict(list) for key in ("norm_e_type", "text_e_type", "norm_e_domain")}
+    for i, f in enumerate(entity_index):
+        for key, bucket in buckets.items():
+            bucket[f[key]].append(i)
+    return buckets
+
+
+def score_entity(device: Dict[str, Any], entity: Dict[str, Any],
+                 query: Optional[Dict[str, Any]] = None,
+                 features: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
     计算设备请求与实体的匹配得分
 
     Args:
         device: 设备请求（intent中的device对象）
         entity: 实体对象
+        query: prepare_device_query 的结果，未提供时现场计算
+        features: prepare_entity_features 的结果，未提供时现场计算
 
     Returns:
         {"score": 得分, "ev": 各字段评估结果, "warnings": 警告列表}
     """
+    if query is None:
+        query = prepare_device_query(device)
+    if features is None:
+        features = prepare_entity_features(entity)
+
     ev = {}
     warnings = []
 
+    # ========== 设备类型匹配（最先计算，用于提前淘汰）==========
+    type_q = query["type_q"]
+
+    e_type = features["e_type"]
+    e_domain = features["e_domain"]
+
+    norm_type_q = query["norm_type_q"]
+    norm_e_domain = features["norm_e_domain"]
+    norm_e_type = features["norm_e_type"]
+
+    type_score = 0.0
+    if norm_type_q:
+        # ⭐ 优先匹配精确的 device_type
+        if (norm_type_q == norm_e_type or
+            normalize_text(type_q) == features["text_e_type"]):
+            type_score = 1.0
+        # 对于独立类型（如 occupancy, motion），不应该只匹配域名
+        elif norm_type_q in ['occupancy', 'motion']:
+            # 独立类型必须精确匹配 device_type
+            type_score = 0.0
+        # 通用类型可以匹配域名
+        elif (norm_type_q == norm_e_domain or
+              fuzzy_match(type_q, e_domain) or
+              fuzzy_match(type_q, e_type)):
+            type_score = 1.0
+        else:
+            # 相似度匹配
+            sim = match_slot(query["type_prepared"], features["type_slot"])
+            type_score = sim["score"]
+
+    ev_type = {
+        "text": type_q,
+        "hit": (norm_e_type or norm_e_domain or e_type) if type_score >= 0.9 else "",
+        "score": type_score
+    }
+
+    # 类型不通过时所有匹配模式都会淘汰该实体，提前返回以跳过楼层/房间/名称计算
+    if type_q and type_score < 0.90:
+        return {"score": -1, "ev": {"device_type": ev_type}, "warnings": warnings}
+
     # ========== 楼层匹配 ==========
-    # ⭐ 优先使用 _en 字段以提高匹配准确性
-    floor_q = device.get("floor_name_en") or device.get("floor_type") or device.get("floor_name") or ""
-    e_floor_name = entity.get("floor_name") or ""
-    e_floor_name_en = entity.get("floor_name_en") or ""
-    e_floor_type = entity.get("floor_type") or ""
-    e_level = str(entity.get("level", "")) if entity.get("level") is not None else ""
+    floor_q = query["floor_q"]
+    e_floor_name = features["e_floor_name"]
+    e_floor_name_en = features["e_floor_name_en"]
+    e_floor_type = features["e_floor_type"]
+    e_level = features["e_level"]
 
     floor_score = 0.0
     if floor_q:
@@ -347,10 +621,10 @@ def score_entity(device: Dict[str, Any], entity: Dict[str, Any]) -> Dict[str, An
             floor_score = 1.0
         else:
             # 规范化后匹配
-            norm_floor_q = normalize_floor(floor_q)
-            norm_e_floor_name = normalize_floor(e_floor_name)
-            norm_e_floor_name_en = normalize_floor(e_floor_name_en)
-            norm_e_floor_type = normalize_floor(e_floor_type)
+            norm_floor_q = query["norm_floor_q"]
+            norm_e_floor_name = features["norm_e_floor_name"]
+            norm_e_floor_name_en = features["norm_e_floor_name_en"]
+            norm_e_floor_type = features["norm_e_floor_type"]
 
             if (norm_floor_q == norm_e_floor_name or
                 norm_floor_q == norm_e_floor_name_en or
@@ -359,7 +633,7 @@ def score_entity(device: Dict[str, Any], entity: Dict[str, Any]) -> Dict[str, An
                 floor_score = 1.0
             else:
                 # 相似度匹配
-                sim = slot_similarity(floor_q, e_floor_name, e_floor_name_en, e_floor_type, e_level)
+                sim = match_slot(query["floor_prepared"], features["floor_slot"])
                 floor_score = sim["score"]
 
     ev["floor"] = {
@@ -369,11 +643,10 @@ def score_entity(device: Dict[str, Any], entity: Dict[str, Any]) -> Dict[str, An
     }
 
     # ========== 房间匹配 ==========
-    # ⭐ 优先使用 _en 字段以提高匹配准确性
-    room_q = device.get("room_name_en") or device.get("room_type") or device.get("room_name") or ""
-    e_room_name = entity.get("room_name") or ""
-    e_room_name_en = entity.get("room_name_en") or ""
-    e_room_type = entity.get("room_type") or ""
+    room_q = query["room_q"]
+    e_room_name = features["e_room_name"]
+    e_room_name_en = features["e_room_name_en"]
+    e_room_type = features["e_room_type"]
 
     room_score = 0.0
     if room_q:
@@ -384,10 +657,10 @@ def score_entity(device: Dict[str, Any], entity: Dict[str, Any]) -> Dict[str, An
             room_score = 1.0
         else:
             # 规范化后匹配
-            norm_room_q = normalize_room(room_q)
-            norm_e_room_name = normalize_room(e_room_name)
-            norm_e_room_name_en = normalize_room(e_room_name_en)
-            norm_e_room_type = normalize_room(e_room_type)
+            norm_room_q = query["norm_room_q"]
+            norm_e_room_name = features["norm_e_room_name"]
+            norm_e_room_name_en = features["norm_e_room_name_en"]
+            norm_e_room_type = features["norm_e_room_type"]
 
             if (norm_room_q == norm_e_room_name or
                 norm_room_q == norm_e_room_name_en or
@@ -395,7 +668,7 @@ def score_entity(device: Dict[str, Any], entity: Dict[str, Any]) -> Dict[str, An
                 room_score = 1.0
             else:
                 # 相似度匹配
-                sim = slot_similarity(room_q, e_room_name, e_room_name_en, e_room_type)
+                sim = match_slot(query["room_prepared"], features["room_slot"])
                 room_score = sim["score"]
 
     ev["room"] = {
@@ -405,31 +678,24 @@ def score_entity(device: Dict[str, Any], entity: Dict[str, Any]) -> Dict[str, An
     }
 
     # ========== 设备名匹配 ==========
-    # ⭐ 优先使用 _en 字段以提高匹配准确性（避免中英文跨语言匹配）
-    name_q = device.get("device_name_en") or device.get("device_name") or ""
-    e_device_name = entity.get("device_name") or ""
-    e_friendly_name = entity.get("attributes", {}).get("friendly_name") or entity.get("friendly_name") or ""
+    name_q = query["name_q"]
 
-    name_sim = slot_similarity(name_q, e_device_name, e_friendly_name)
+    name_sim = match_slot(query["name_prepared"], features["name_slot"])
 
     # 位置提取功能
-    name_contains_location = False
-    extracted_location = ""
+    extracted_location = query["extracted_location"]
     location_match_bonus = 0.0
 
-    if name_q:
-        name_contains_location, extracted_location = extract_location_from_name(name_q)
-
-        # 如果设备名包含位置，检查位置是否匹配
-        if name_contains_location and extracted_location:
-            norm_e_room_name = normalize_room(e_room_name)
-            norm_e_room_name_en = normalize_room(e_room_name_en)
-            norm_e_room_type = normalize_room(e_room_type)
+    # 如果设备名包含位置，检查位置是否匹配
+    if extracted_location:
+        norm_e_room_name = features["norm_e_room_name"]
+        norm_e_room_name_en = features["norm_e_room_name_en"]
+        norm_e_room_type = features["norm_e_room_type"]
 
-            if (extracted_location == norm_e_room_name or
-                extracted_location == norm_e_room_name_en or
-                extracted_location == norm_e_room_type):
-                location_match_bonus = LOCATION_BONUS
+        if (extracted_location == norm_e_room_name or
+            extracted_location == norm_e_room_name_en or
+            extracted_location == norm_e_room_type):
+            location_match_bonus = LOCATION_BONUS
 
     ev["device_name"] = {
         "text": name_q,
@@ -437,43 +703,7 @@ def score_entity(device: Dict[str, Any], entity: Dict[str, Any]) -> Dict[str, An
         "score": name_sim["score"]
     }
 
-    # ========== 设备类型匹配 ==========
-    type_q = (device.get("device_type") or "").lower()
-    if not type_q and device.get("service"):
-        type_q = device["service"].split(".")[0].lower()
-
-    e_type = (entity.get("device_type") or "").lower()
-    e_domain = entity.get("entity_id", "").split(".")[0] if entity.get("entity_id") else ""
-
-    norm_type_q = normalize_domain(type_q)
-    norm_e_domain = normalize_domain(e_domain)
-    norm_e_type = normalize_domain(e_type)
-
-    type_score = 0.0
-    if norm_type_q:
-        # ⭐ 优先匹配精确的 device_type
-        if (norm_type_q == norm_e_type or
-            normalize_text(type_q) == normalize_text(e_type)):
-            type_score = 1.0
-        # 对于独立类型（如 occupancy, motion），不应该只匹配域名
-        elif norm_type_q in ['occupancy', 'motion']:
-            # 独立类型必须精确匹配 device_type
-            type_score = 0.0
-        # 通用类型可以匹配域名
-        elif (norm_type_q == norm_e_domain or
-              fuzzy_match(type_q, e_domain) or
-              fuzzy_match(type_q, e_type)):
-            type_score = 1.0
-        else:
-            # 相似度匹配
-            sim = slot_similarity(norm_type_q, norm_e_domain, e_type)
-            type_score = sim["score"]
-
-    ev["device_type"] = {
-        "text": type_q,
-        "hit": (norm_e_type or norm_e_domain or e_type) if type_score >= 0.9 else "",
-        "score": type_score
-    }
+    ev["device_type"] = ev_type
 
     # ========== 场景判断 ==========
     is_all_devices = not floor_q and not room_q and not name_q and type_q
@@ -491,7 +721,7 @@ def score_entity(device: Dict[str, Any], entity: Dict[str, Any]) -> Dict[str, An
     name_pass = name_sim["score"] >= THRESHOLDS["name"] if name_q else True
     type_pass = type_score >= 0.90 if type_q else True
 
-    is_generic_name = is_generic_device_name(name_q)
+    is_generic_name = query["is_generic_name"]
 
     # 楼层模式（只有楼层+类型，无房间名）
     floor_only_mode = floor_q and not room_q and not name_q and type_q
@@ -535,8 +765,7 @@ def score_entity(device: Dict[str, Any], entity: Dict[str, Any]) -> Dict[str, An
 
     # ========== 域一致性检查 ==========
     if device.get("service"):
-        svc_domain = device["service"].split(".")[0].lower()
-        norm_svc_domain = normalize_domain(svc_domain)
+        norm_svc_domain = query["norm_svc_domain"]
         if norm_svc_domain and norm_e_domain:
             if norm_svc_domain == norm_e_domain:
                 base_score += 0.03
@@ -570,48 +799,45 @@ def match_entities(intent_data: Dict[str, Any], entities: List[Dict[str, Any]])
     if not isinstance(devices, list):
         devices = []
 
+    entity_index = build_entity_index(entities)
+    type_buckets = build_type_buckets(entity_index)
+
     for device in devices:
+        # 设备侧查询字段只计算一次，所有实体复用
+        query = prepare_device_query(device)
+
         # 确定设备类型/域
-        svc_domain = ""
-        if device.get("service"):
-            svc_domain = device["service"].split(".")[0].lower()
-        elif device.get("device_type"):
-            svc_domain = device["device_type"].lower()
+        svc_domain = query["svc_domain"] or (device.get("device_type") or "").lower()
 
         norm_svc_domain = normalize_domain(svc_domain)
 
         # 过滤实体池
-        def entity_filter(e):
-            if not norm_svc_domain:
-                return True
-            e_domain = e.get("entity_id", "").split(".")[0] if e.get("entity_id") else ""
-            e_type = (e.get("device_type") or "").lower()
-            norm_e_domain = normalize_domain(e_domain)
-            norm_e_type = normalize_domain(e_type)
-            
+        if not norm_svc_domain:
+            # 无类型约束时允许所有实体通过
+            positions = range(len(entities))
+        else:
             # ⭐ 优先匹配精确的 device_type
-            if norm_svc_domain == norm_e_type or normalize_text(svc_domain) == normalize_text(e_type):
-                return True  # device_type 精确匹配
-            
+            hits = set(type_buckets["norm_e_type"].get(norm_svc_domain, ()))
+            hits.update(type_buckets["text_e_type"].get(normalize_text(svc_domain), ()))
             # 如果 device_type 不匹配，检查域名是否匹配
-            # 但如果查询的类型有独立定义（如 occupancy, motion），则不应匹配到其他类型
-            if norm_svc_domain == norm_e_domain:
-                # 检查查询类型是否是独立类型（非通用域名）
-                is_independent_type = norm_svc_domain in ['occupancy', 'motion']
-                if is_independent_type:
-                    # 独立类型必须精确匹配 device_type
-                    return norm_svc_domain == norm_e_type or normalize_text(svc_domain) == normalize_text(e_type)
-                return True  # 通用域名匹配
-            
-            # 如果有设备名称，也允许通过
-            return bool(device.get("device_name")) or bool(device.get("device_name_en"))
-
-        entity_pool = [e for e in entities if entity_filter(e)]
+            # 但独立类型（如 occupancy, motion）必须精确匹配 device_type，不按域名匹配
+            is_independent_type = norm_svc_domain in ('occupancy', 'motion')
+            domain_hits = type_buckets["norm_e_domain"].get(norm_svc_domain, ())
+            if device.get("device_name") or device.get("device_name_en"):
+                # 有设备名称时允许其余实体通过，仅排除域名相同但类型不符的独立类型实体
+                excluded = set(domain_hits) - hits if is_independent_type else ()
+                positions = [i for i in range(len(entities)) if i not in excluded]
+            else:
+                if not is_independent_type:
+                    hits.update(domain_hits)
+                positions = sorted(hits)
+
+        pool = [(entities[i], entity_index[i]) for i in positions]
 
         # 对每个实体评分
         scored_entities = []
-        for entity in entity_pool:
-            score_result = score_entity(device, entity)
+        for entity, features in pool:
+            score_result = score_entity(device, entity, query, features)
             if score_result["score"] >= 0:
                 scored_entities.append({
                     "entity": entity,
@@ -620,9 +846,8 @@ def match_entities(intent_data: Dict[str, Any], entities: List[Dict[str, Any]])
                     "warnings": score_result["warnings"]
                 })
 
-        # 按得分排序
-        scored_entities.sort(key=lambda x: x["score"], reverse=True)
-        top_k = scored_entities[:BEST_K]
+        # 按得分取 Top K（部分排序，等价于稳定排序后截取）
+        top_k = heapq.nlargest(BEST_K, scored_entities, key=lambda x: x["score"])
 
         # 收集警告
         all_warnings = []
@@ -641,27 +866,26 @@ def match_entities(intent_data: Dict[str, Any], entities: List[Dict[str, Any]])
         suggestions = []
         if not top_k:
             # 使用宽松权重重新计算
-            loose_scored = []
-            for entity in entity_pool:
-                floor_q = device.get("floor_name") or device.get("floor_name_en") or device.get("floor_type") or ""
-                room_q = device.get("room_name") or device.get("room_name_en") or device.get("room_type") or ""
-                name_q = device.get("device_name") or device.get("device_name_en") or ""
-                type_q = (device.get("device_type") or "").lower()
-                if not type_q and device.get("service"):
-                    type_q = device["service"].split(".")[0].lower()
+            floor_q = device.get("floor_name") or device.get("floor_name_en") or device.get("floor_type") or ""
+            room_q = device.get("room_name") or device.get("room_name_en") or device.get("room_type") or ""
+            name_q = device.get("device_name") or device.get("device_name_en") or ""
+            type_q = query["type_q"]
 
-                e_type = (entity.get("device_type") or "").lower()
+            # 设备侧的四个槽位查询只预处理一次
+            floor_p, room_p, name_p, type_p = (prepare_query(q) for q in (floor_q, room_q, name_q, type_q))
 
-                score = (0.15 * slot_similarity(floor_q, entity.get("floor_name"), entity.get("floor_name_en"), entity.get("floor_type"))["score"] +
-                        0.40 * slot_similarity(room_q, entity.get("room_name"), entity.get("room_name_en"), entity.get("room_type"))["score"] +
-                        0.30 * slot_similarity(name_q, entity.get("device_name"), entity.get("attributes", {}).get("friendly_name"))["score"] +
-                        0.15 * slot_similarity(type_q, e_type)["score"])
+            loose_scored = []
+            for entity, features in pool:
+                e_type = features["e_type"]
 
-                loose_scored.append({"entity": entity, "score": score})
+                score = (0.15 * match_slot(floor_p, prepare_slot(entity.get("floor_name"), entity.get("floor_name_en"), entity.get("floor_type")))["score"] +
+                        0.40 * match_slot(room_p, prepare_slot(entity.get("room_name"), entity.get("room_name_en"), entity.get("room_type")))["score"] +
+                        0.30 * match_slot(name_p, prepare_slot(entity.get("device_name"), entity.get("attributes", {}).get("friendly_name")))["score"] +
+                        0.15 * match_slot(type_p, prepare_slot(e_type))["score"])
 
-            loose_scored.sort(key=lambda x: x["score"], reverse=True)
+                loose_scored.append({"entity": entity, "score": score})
 
-            for item in loose_scored[:3]:
+            for item in heapq.nlargest(3, loose_scored, key=lambda x: x["score"]):
                 e = item["entity"]
                 suggestions.append({
                     "entity_id": e.get("entity_id"),
@@ -678,7 +902,7 @@ def match_entities(intent_data: Dict[str, Any], entities: List[Dict[str, Any]])
                 "floor": device.get("floor_name_en") or device.get("floor_type") or device.get("floor_name"),
                 "room": device.get("room_name_en") or device.get("room_type") or device.get("room_name"),
                 "device_name": device.get("device_name_en") or device.get("device_name"),
-                "device_type": device.get("device_type") or (device.get("service", "").split(".")[0] if device.get("service") else None),
+                "device_type": device.get("device_type") or (device["service"].partition(".")[0] if device.get("service") else None),
                 "service": device.get("service"),
                 "service_data": device.get("service_data", {})
             },
@@ -724,6 +948,8 @@ def call_llm_for_suggestions(user_query: str, entities_summary: List[Dict[str, A
     Returns:
         {"suggestions": [...], "new_aliases": {...}}
     """
+    global _ROOM_REV, _LOCATION_MATCHER
+
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
         print("警告: 未设置 OPENAI_API_KEY，跳过 LLM 调用", file=sys.stderr)
@@ -791,6 +1017,11 @@ def call_llm_for_suggestions(user_query: str, entities_summary: List[Dict[str, A
                             if alias not in ROOM_ALIASES[room_type]:
                                 ROOM_ALIASES[room_type].append(alias)
                                 print(f"添加新房间别名: {alias} -> {room_type}", file=sys.stderr)
+                    # 别名表已变化，重建反向索引并清空依赖它的缓存
+                    _ROOM_REV = _build_alias_reverse_index(ROOM_ALIASES)
+                    _LOCATION_MATCHER = _build_location_matcher(ROOM_ALIASES)
+                    _normalize_room.cache_clear()
+                    _ENTITY_INDEX_CACHE.clear()
 
                 return llm_result
 
@@ -809,13 +1040,44 @@ def call_llm_for_suggestions(user_query: str, entities_summary: List[Dict[str, A
 
 # ===================== 主入口函数 =====================
 
+def read_input() -> Any:
+    """
+    从 stdin 读取请求 JSON：orjson 可用时优先使用，失败时回退到标准库
+
+    orjson 不接受的输入（如 NaN、Infinity）交给标准库解析。
+    """
+    raw = sys.stdin.buffer.read()
+    if _HAS_ORJSON:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
+
+
+def write_output(result: Any) -> None:
+    """
+    输出缩进的 JSON 结果：orjson 可用时优先使用，无法序列化时回退到标准库
+    """
+    if _HAS_ORJSON:
+        try:
+            data = orjson.dumps(result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass  # orjson 不支持的类型（如超过 64 位的整数）交给标准库
+        else:
+            sys.stdout.buffer.write(data + b"\n")
+            sys.stdout.buffer.flush()
+            return
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
 def main():
     """
     命令行入口函数：从 stdin 读取 JSON，输出匹配结果
     """
     try:
         # 从 stdin 读取输入
-        input_data = json.load(sys.stdin)
+        input_data = read_input()
 
         # 解析输入
         intent_data = input_data.get("intent", {})
@@ -850,7 +1112,7 @@ def main():
                     action["llm_reason"] = llm_result["reason"]
 
         # 输出结果
-        print(json.dumps(result, ensure_ascii=False, indent=2))
+        write_output(result)
         return 0
 
     except Exception as e:
@@ -15,39 +15,71 @@
 
 import sys
 import json
-import re
-from typing import List, Dict, Any, Tuple, Optional
-from collections import OrderedDict
+import math
+import functools
+import heapq
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Tuple, Optional, Set
+from collections import Counter
 
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 
-# ============ 优化 1: 预编译正则表达式 ============
-_RE_SPACE = re.compile(r"\s+")
-_RE_DASH = re.compile(r"[_-]")
-_RE_KEEP = re.compile(r"[^a-z0-9\u4e00-\u9fa5]")
+try:
+    from lru import LRU  # lru-dict: C 实现的 LRU 字典（可选依赖）
+except ImportError:
+    LRU = None
+
+try:
+    import ahocorasick  # pyahocorasick: 设备名位置提取的多模式匹配（可选依赖）
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson  # 更快的 JSON 解析与序列化（可选依赖）
+except ImportError:
+    orjson = None
+
+# ============ 优化 1: 单遍字符转换表 ============
+class _KeepTable(dict):
+    """str.translate 映射：只保留 [a-z0-9\u4e00-\u9fa5]，其余码点删除（首次查询时缓存）"""
+    
+    def __missing__(self, cp: int) -> Optional[int]:
+        ch = chr(cp)
+        keep = 'a' <= ch <= 'z' or '0' <= ch <= '9' or '\u4e00' <= ch <= '\u9fa5'
+        self[cp] = cp if keep else None
+        return self[cp]
+
+
+_TRANSLATE = _KeepTable()
+for _cp in range(0x80):
+    _TRANSLATE[_cp]  # 预填充 ASCII
+del _cp
 
 
 # ============ 优化 2: LRU 缓存实现 ============
+_MISSING = object()
+
+
 class LRUCache:
-    """简单的 LRU 缓存实现"""
+    """简单的 LRU 缓存实现（基于有序 dict：命中时删除并重新插入到末尾，淘汰最早的键）"""
     def __init__(self, maxsize: int = 1000):
-        self.cache = OrderedDict()
+        self.cache = {}
         self.maxsize = maxsize
     
     def get(self, key):
-        if key in self.cache:
-            self.cache.move_to_end(key)
-            return self.cache[key]
-        return None
+        val = self.cache.pop(key, _MISSING)
+        if val is _MISSING:
+            return None
+        self.cache[key] = val
+        return val
     
     def set(self, key, value):
-        if key in self.cache:
-            self.cache.move_to_end(key)
+        self.cache.pop(key, None)
         self.cache[key] = value
         if len(self.cache) > self.maxsize:
-            self.cache.popitem(last=False)
+            del self.cache[next(iter(self.cache))]
+    
+    __setitem__ = set
     
     def __contains__(self, key):
         return key in self.cache
@@ -56,29 +88,29 @@ class LRUCache:
         return len(self.cache)
 
 
+def make_lru_cache(maxsize: int):
+    """优先使用 C 实现的 lru-dict，不可用时回退到纯 Python 的 LRUCache（同样支持 get / [] 赋值）"""
+    if LRU is not None:
+        return LRU(maxsize)
+    return LRUCache(maxsize=maxsize)
+
+
 # 使用 LRU 缓存
-_normalize_cache = LRUCache(maxsize=1000)
-_tfidf_cache = LRUCache(maxsize=500)
+_ngram_cache = make_lru_cache(2000)
 
 
 # ============ 优化 3: 规范化函数 ============
+@functools.lru_cache(maxsize=8192)
+def _normalize_impl(text: str) -> str:
+    # 驻留结果：别名索引、类型索引和各缓存的键共享同一字符串对象，比较时可按身份短路
+    return sys.intern(str(text).lower().translate(_TRANSLATE))
+
+
 def normalize(text: str) -> str:
     """带缓存的文本规范化"""
     if not text:
         return ''
-    
-    cached = _normalize_cache.get(text)
-    if cached is not None:
-        return cached
-    
-    s = str(text).lower()
-    s = _RE_SPACE.sub("", s)
-    s = _RE_DASH.sub("", s)
-    s = _RE_KEEP.sub("", s)
-    result = s.strip()
-    
-    _normalize_cache.set(text, result)
-    return result
+    return _normalize_impl(text)
 
 
 # ============ 优化 4: 修复泛指设备名集合 ============
@@ -102,43 +134,49 @@ GENERIC_NAMES_RAW = [
 # 预规范化，避免运行时重复计算
 GENERIC_NAMES = {normalize(name) for name in GENERIC_NAMES_RAW}
 
+# 默认阈值与权重（模块级常量，避免每次评分都构造字典；只读，不要修改）
+DEFAULT_THRESHOLDS = {'floor': 0.7, 'room': 0.7, 'type': 0.65, 'name': 0.8}
+DEFAULT_WEIGHTS = {'F': 0.15, 'R': 0.40, 'N': 0.30, 'T': 0.15}
+
 
 # ============ 优化 5: 统一字段提取 ============
+def _level(obj: Dict[str, Any]) -> str:
+    return str(obj.get('level', '') or '')
+
+
+def _friendly_name(obj: Dict[str, Any]) -> str:
+    return (obj.get('attributes', {}) or {}).get('friendly_name', '')
+
+
+def _device_type_lower(obj: Dict[str, Any]) -> str:
+    return (obj.get('device_type', '') or '').lower()
+
+
+def _entity_domain(obj: Dict[str, Any]) -> str:
+    return str(obj.get('entity_id', '')).partition('.')[0] if obj.get('entity_id') else ''
+
+
+# 字段 -> 候选来源（按优先级）：字符串为直接取值的键，函数用于需要转换或嵌套访问的值
+_FIELD_SPECS = {
+    'floor': ('floor_name_en', 'floor_type', 'floor_name', _level),
+    'room': ('room_name_en', 'room_type', 'room_name'),
+    'name': ('device_name', _friendly_name),
+    'type': (_device_type_lower, _entity_domain),
+}
+
+
 def extract_field_candidates(obj: Dict[str, Any], field: str) -> List[str]:
     """统一提取字段候选值"""
-    if field == 'floor':
-        return [
-            obj.get('floor_name_en', ''),
-            obj.get('floor_type', ''),
-            obj.get('floor_name', ''),
-            str(obj.get('level', '') or '')
-        ]
-    elif field == 'room':
-        return [
-            obj.get('room_name_en', ''),
-            obj.get('room_type', ''),
-            obj.get('room_name', '')
-        ]
-    elif field == 'name':
-        return [
-            obj.get('device_name', ''),
-            (obj.get('attributes', {}) or {}).get('friendly_name', '')
-        ]
-    elif field == 'type':
-        return [
-            (obj.get('device_type', '') or '').lower(),
-            (str(obj.get('entity_id', '')).split('.')[0] 
-             if obj.get('entity_id') else '')
-        ]
-    return []
+    return [obj.get(k, '') if type(k) is str else k(obj)
+            for k in _FIELD_SPECS.get(field, ())]
 
 
 def get_primary_field(obj: Dict[str, Any], field: str) -> str:
     """获取主要字段值（第一个非空值）"""
-    candidates = extract_field_candidates(obj, field)
-    for c in candidates:
-        if c:
-            return c
+    for k in _FIELD_SPECS.get(field, ()):
+        v = obj.get(k) if type(k) is str else k(obj)
+        if v:
+            return v
     return ''
 
 
@@ -157,8 +195,19 @@ def build_alias_reverse_index(alias_map: Dict[str, List[str]]) -> Dict[str, str]
     return index
 
 
-# 全局别名索引（在 process 中初始化）
+# 全局别名索引（在 process 中初始化，别名不变时跨请求复用）
 _alias_indices = {}
+_alias_fingerprint = None
+
+
+def aliases_fingerprint(aliases: Dict[str, Any]) -> Any:
+    """别名表指纹（保留键顺序：房间顺序决定位置提取的优先级）"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(aliases)
+        except TypeError:
+            pass
+    return json.dumps(aliases, ensure_ascii=False, default=str)
 
 
 def expand_alias_fast(value: str, alias_type: str) -> List[str]:
@@ -191,44 +240,58 @@ def expand_alias(value: str, alias_map: Dict[str, List[str]]) -> List[str]:
 
 
 # ============ 优化 7: 带快速路径的相似度计算 ============
-def field_similarity(query: str, candidates: List[str]) -> float:
-    """优化版相似度计算 - 添加精确匹配快速路径"""
-    # 先过滤掉 None 值，然后排序
-    valid_candidates = [c for c in candidates if c is not None]
-    cache_key = (query, tuple(sorted(valid_candidates)))
-    
-    cached = _tfidf_cache.get(cache_key)
+def _count_ngrams(s: str, n_lo: int = 2, n_hi: int = 4) -> Counter:
+    return Counter(
+        s[i:i + n]
+        for n in range(n_lo, n_hi + 1)
+        for i in range(len(s) - n + 1)
+    )
+
+
+def _ngram_counter(s: str, n_lo: int = 2, n_hi: int = 4) -> Tuple:
+    """字符 n-gram 计数及其 L2 范数（按规范化后的字符串缓存）"""
+    cached = _ngram_cache.get(s)
     if cached is not None:
         return cached
     
-    q = normalize(query)
-    cands = [normalize(c) for c in valid_candidates if c]
-    cands = [c for c in cands if c]
-    
-    if not q or not cands:
-        result = 0.0
-    else:
-        # 快速路径 1: 精确匹配 (最快)
-        if q in cands:
-            result = 1.0
-        # 快速路径 2: 包含关系 (很快)
-        elif any(q in c or c in q for c in cands):
-            result = 0.95
-        # 慢路径: TF-IDF 计算
-        else:
-            corpus = cands + [q]
-            vec = TfidfVectorizer(analyzer='char', ngram_range=(2, 4))
-            try:
-                X = vec.fit_transform(corpus)
-                sims = cosine_similarity(X[-1], X[:-1]).flatten()
-                result = float(np.max(sims)) if sims.size > 0 else 0.0
-            except ValueError:
-                result = 0.0
-    
-    _tfidf_cache.set(cache_key, result)
+    counts = _count_ngrams(s, n_lo, n_hi)
+    result = (counts, math.sqrt(sum(v * v for v in counts.values())))
+    _ngram_cache[s] = result
     return result
 
 
+def _ngram_cosine(a: Tuple, b: Tuple) -> float:
+    """两个 n-gram 计数向量的余弦相似度"""
+    (ca, na), (cb, nb) = a, b
+    if not na or not nb:
+        return 0.0
+    if len(ca) > len(cb):
+        ca, cb = cb, ca
+    dot = sum(v * cb[k] for k, v in ca.items() if k in cb)
+    return dot / (na * nb)
+
+
+def normalize_candidates(candidates: List[Any]) -> List[str]:
+    """规范化候选值并去掉空值"""
+    cands = [normalize(c) for c in candidates if c]
+    return [c for c in cands if c]
+
+
+def normalized_similarity(q: str, cands: List[str]) -> float:
+    """已规范化的查询与候选之间的相似度"""
+    if not q or not cands:
+        return 0.0
+    # 快速路径 1: 精确匹配 (最快)
+    if q in cands:
+        return 1.0
+    # 快速路径 2: 包含关系 (很快)
+    if any(q in c or c in q for c in cands):
+        return 0.95
+    # 慢路径: 字符 n-gram (2-4) 余弦相似度
+    qv = _ngram_counter(q)
+    return max(_ngram_cosine(qv, _ngram_counter(c)) for c in cands)
+
+
 # ============ 优化 8: 智能组合过滤 ============
 def filter_candidates(dev: Dict[str, Any], 
                       entities: List[Dict[str, Any]], 
@@ -294,27 +357,283 @@ def join_fields(*parts: Any) -> str:
     return ' '.join(vals)
 
 
-def detect_location_from_name(name_q: str, room_aliases: Dict[str, List[str]]) -> str:
+def build_location_matcher(room_aliases: Dict[str, List[str]]) -> Any:
+    """构建房间位置匹配器
+    
+    pyahocorasick 可用时返回 Aho-Corasick 自动机（值为 (房间顺序, 房间代码)），
+    否则返回按房间顺序排列的 [(规范化别名, 房间代码), ...] 列表。
+    """
+    patterns = []
+    for order, (room_code, aliases) in enumerate(room_aliases.items()):
+        for a in [room_code] + list(aliases):
+            na = normalize(a)
+            if na:
+                patterns.append((na, order, room_code))
+    
+    if ahocorasick is None:
+        return [(na, room_code) for na, _, room_code in patterns]
+    
+    automaton = ahocorasick.Automaton()
+    for na, order, room_code in patterns:
+        # 同一别名属于多个房间时保留靠前的房间
+        if not automaton.exists(na):
+            automaton.add_word(na, (order, room_code))
+    if len(automaton):
+        automaton.make_automaton()
+    return automaton
+
+
+# 位置匹配器（在 process 中随别名一起构建）
+_location_matcher = []
+
+
+def detect_location_from_name(name_q: str, matcher: Any) -> str:
+    """从设备名中提取房间代码，多个房间命中时返回别名表中靠前的房间"""
     n = normalize(name_q)
     if not n:
         return ''
-    for room_code, aliases in room_aliases.items():
-        if normalize(room_code) and normalize(room_code) in n:
-            return room_code
-        for a in aliases:
-            na = normalize(a)
-            if na and na in n:
+    if isinstance(matcher, list):
+        for na, room_code in matcher:
+            if na in n:
                 return room_code
-    return ''
+        return ''
+    if not len(matcher):
+        return ''
+    hits = [value for _, value in matcher.iter(n)]
+    return min(hits)[1] if hits else ''
 
 
-# ============ 核心评分函数 ============
-def compute_scores_for_device(dev: Dict[str, Any], 
-                              e: Dict[str, Any], 
-                              aliases: Dict[str, Any], 
-                              cfg: Dict[str, Any]) -> Tuple[float, Dict[str, Any]]:
-    """计算设备匹配得分"""
+# ============ 优化 10: 预计算实体/设备特征 ============
+@dataclass
+class EntityFeatures:
+    """单个实体的规范化字段（首次参与评分时计算，请求内复用）"""
+    floor: List[str]         # 规范化后的楼层候选
+    room: List[str]          # 规范化后的房间候选
+    name: List[str]          # 规范化后的名称候选
+    type: List[str]          # 别名扩展后的类型候选
+    raw_type: List[str]      # 未做别名扩展的类型候选（宽松建议使用）
+    room_primary: str        # 主房间字段（规范化）
+
+
+def compute_entity_features(e: Dict[str, Any]) -> EntityFeatures:
+    """计算单个实体的规范化字段（需在 _alias_indices 初始化之后调用）"""
+    # 类型候选使用别名扩展
+    e_type_cands = extract_field_candidates(e, 'type')
+    e_types_norm = []
+    for c in e_type_cands:
+        e_types_norm.extend(expand_alias_fast(c, 'device_types'))
+    return EntityFeatures(
+        floor=normalize_candidates(extract_field_candidates(e, 'floor')),
+        room=normalize_candidates(extract_field_candidates(e, 'room')),
+        name=normalize_candidates(extract_field_candidates(e, 'name')),
+        type=normalize_candidates([' '.join(e_types_norm)] if e_types_norm else e_type_cands),
+        raw_type=normalize_candidates(e_type_cands),
+        room_primary=normalize(get_primary_field(e, 'room'))
+    )
+
+
+class EntityFeatureTable(dict):
+    """实体下标 -> EntityFeatures，首次访问时计算并缓存（请求内有效）
+    
+    过滤后的候选池通常只有少数实体，按需计算避免规范化整个实体列表。
+    """
+    
+    def __init__(self, entities: List[Dict[str, Any]]):
+        super().__init__()
+        self.entities = entities
+        self.index_of = {id(e): i for i, e in enumerate(entities)}  # id(实体) -> 下标
+    
+    def __missing__(self, i: int) -> EntityFeatures:
+        f = self[i] = compute_entity_features(self.entities[i])
+        return f
+
+
+@dataclass
+class CandidatePool:
+    """过滤后的候选池（请求内按设备签名缓存，签名相同的设备共用）"""
+    entities: List[Dict[str, Any]]  # 候选实体
+    idx: List[int]                  # 对应的实体下标
+    matrices: Dict[str, 'FieldMatrix'] = field(default_factory=dict)  # 字段 -> 批量余弦矩阵（按需构建）
+    name_postings: Optional[Dict[str, Set[int]]] = None  # 名称 bigram -> 实体下标（按需构建）
+    short_names: Set[int] = field(default_factory=set)  # 含单字符名称候选的实体下标
+
+
+NAME_GRAM = 2  # 名称倒排索引的 n-gram 长度（与余弦相似度的最小 n 一致）
+
+
+def _name_grams(s: str) -> Set[str]:
+    return {s[i:i + NAME_GRAM] for i in range(len(s) - NAME_GRAM + 1)}
+
+
+def build_name_postings(cpool: CandidatePool, feats: EntityFeatureTable) -> None:
+    """为候选池内的实体构建名称 n-gram 倒排索引"""
+    postings: Dict[str, Set[int]] = {}
+    for i in cpool.idx:
+        for c in feats[i].name:
+            if len(c) < NAME_GRAM:
+                cpool.short_names.add(i)
+            for g in _name_grams(c):
+                postings.setdefault(g, set()).add(i)
+    cpool.name_postings = postings
+
+
+def candidate_set_for_device(dev_q: Dict[str, Any], 
+                             cpool: CandidatePool,
+                             feats: EntityFeatureTable, 
+                             cfg: Dict[str, Any]) -> Optional[Set[int]]:
+    """用名称倒排索引求可能通过名称阈值的实体下标集合，返回 None 表示不剪枝
+    
+    名称相似度 > 0 要求与查询共享至少一个 bigram（精确/包含匹配同样如此），
+    唯一例外是单字符候选被查询包含，这类实体始终保留。
+    """
+    name_norm = dev_q['name_norm']
+    if not dev_q['name_q'] or dev_q['is_generic'] or len(name_norm) < NAME_GRAM:
+        return None
+    TH = cfg.get('thresholds', DEFAULT_THRESHOLDS)
+    if TH.get('name', 0.8) <= 0:
+        return None
+    if cpool.name_postings is None:
+        build_name_postings(cpool, feats)
+    cand = set(cpool.short_names)
+    for g in _name_grams(name_norm):
+        cand.update(cpool.name_postings.get(g, ()))
+    return cand
+
+
+# ============ 优化 11: 批量 n-gram 余弦相似度 ============
+BULK_MIN_POOL = 256  # 参与评分的候选达到该规模时改用 numpy 批量计算（更小的池构建矩阵的开销抵不过收益）
+
+_SEP = '\x00'  # 规范化后的字符串不含该字符，可安全用作拼接分隔符
+
+
+@dataclass
+class FieldMatrix:
+    """候选池内某字段全部候选文本（去重）的 n-gram 稀疏矩阵（COO 形式），每个候选池构建一次"""
+    vocab: Dict[str, int]      # n-gram -> 列号
+    rows: np.ndarray           # 非零元所在行（文本编号）
+    cols: np.ndarray           # 非零元所在列（n-gram 编号）
+    vals: np.ndarray           # 非零元计数
+    norms: np.ndarray          # 每个文本的 L2 范数
+    pair_text: np.ndarray      # (实体, 候选) 对应的文本编号
+    pair_owner: np.ndarray     # (实体, 候选) 对应的实体下标
+    texts: List[str]           # 文本编号 -> 文本
+    by_text: Dict[str, int]    # 文本 -> 文本编号
+    owners: List[List[int]]    # 文本编号 -> 含该文本的实体下标
+    corpus: str                # 所有文本以 _SEP 拼接，用于查询串包含检测
+    offsets: np.ndarray        # 各文本在 corpus 中的起始位置
+
+
+def build_field_matrix(cands_per_entity: List[Tuple[int, List[str]]]) -> FieldMatrix:
+    """把 (实体下标, 规范化候选) 编码为稀疏 n-gram 计数矩阵（相同文本只编码一次）"""
+    vocab: Dict[str, int] = {}
+    by_text: Dict[str, int] = {}
+    texts, owners, pair_text, pair_owner = [], [], [], []
+    for ent_idx, cands in cands_per_entity:
+        for c in cands:
+            row = by_text.get(c)
+            if row is None:
+                row = by_text[c] = len(texts)
+                texts.append(c)
+                owners.append([])
+            owners[row].append(ent_idx)
+            pair_text.append(row)
+            pair_owner.append(ent_idx)
+    
+    rows, cols, vals, norms, offsets = [], [], [], [], []
+    pos = 0
+    for row, c in enumerate(texts):
+        counts = _count_ngrams(c)
+        for g, v in counts.items():
+            rows.append(row)
+            cols.append(vocab.setdefault(g, len(vocab)))
+            vals.append(v)
+        norms.append(math.sqrt(sum(v * v for v in counts.values())))
+        offsets.append(pos)
+        pos += len(c) + 1
+    return FieldMatrix(
+        vocab=vocab,
+        rows=np.asarray(rows, dtype=np.intp),
+        cols=np.asarray(cols, dtype=np.intp),
+        vals=np.asarray(vals, dtype=np.float64),
+        norms=np.asarray(norms, dtype=np.float64),
+        pair_text=np.asarray(pair_text, dtype=np.intp),
+        pair_owner=np.asarray(pair_owner, dtype=np.intp),
+        texts=texts,
+        by_text=by_text,
+        owners=owners,
+        corpus=_SEP.join(texts),
+        offsets=np.asarray(offsets, dtype=np.intp)
+    )
+
+
+def bulk_similarity(q: str, fm: FieldMatrix, n_entities: int) -> np.ndarray:
+    """一次计算查询与矩阵内实体的 normalized_similarity，结果按实体下标排列（池外实体为 0）"""
+    sims = np.zeros(n_entities, dtype=np.float64)
+    if not q or not fm.texts:
+        return sims
+    
+    # 慢路径: 所有文本的余弦一次算完，再按实体取最大值
+    q_counts = _count_ngrams(q)
+    qv = np.zeros(len(fm.vocab), dtype=np.float64)
+    for g, v in q_counts.items():
+        col = fm.vocab.get(g)
+        if col is not None:
+            qv[col] = v
+    q_norm = math.sqrt(sum(v * v for v in q_counts.values()))
+    if q_norm and qv.any():
+        dots = np.bincount(fm.rows, weights=fm.vals * qv[fm.cols], minlength=len(fm.texts))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cos = np.where(fm.norms > 0, dots / (fm.norms * q_norm), 0.0)
+        np.maximum.at(sims, fm.pair_owner, cos[fm.pair_text])
+    
+    # 快速路径 2: 包含关系（文本是查询的子串，或查询是文本的子串）
+    hit_rows = set()
+    for i in range(len(q)):
+        for j in range(i + 1, len(q) + 1):
+            row = fm.by_text.get(q[i:j])
+            if row is not None:
+                hit_rows.add(row)
+    start = fm.corpus.find(q)
+    while start != -1:
+        row = int(np.searchsorted(fm.offsets, start, side='right')) - 1
+        hit_rows.add(row)
+        start = fm.corpus.find(q, fm.offsets[row] + len(fm.texts[row]) + 1)
+    for row in hit_rows:
+        sims[fm.owners[row]] = 0.95
     
+    # 快速路径 1: 精确匹配
+    row = fm.by_text.get(q)
+    if row is not None:
+        sims[fm.owners[row]] = 1.0
+    return sims
+
+
+def field_matrix(cpool: CandidatePool, feats: EntityFeatureTable, fname: str) -> FieldMatrix:
+    """取候选池某字段的批量余弦矩阵，首次使用时只对池内实体构建"""
+    fm = cpool.matrices.get(fname)
+    if fm is None:
+        fm = cpool.matrices[fname] = build_field_matrix((i, getattr(feats[i], fname)) for i in cpool.idx)
+    return fm
+
+
+def bulk_field_scores(dev_q: Dict[str, Any], cpool: CandidatePool,
+                      feats: EntityFeatureTable) -> Dict[str, np.ndarray]:
+    """批量计算设备查询在各字段上对池内实体的相似度（查询为空或泛指名称的字段记为 0）"""
+    n = len(feats.entities)
+    zeros = np.zeros(n, dtype=np.float64)
+    out = {}
+    for fname, qkey in (('floor', 'floor_norm'), ('room', 'room_norm'),
+                        ('name', 'name_norm'), ('type', 'type_norm')):
+        q = dev_q[qkey]
+        if not q or (fname == 'name' and dev_q['is_generic']):
+            out[fname] = zeros
+            continue
+        out[fname] = bulk_similarity(q, field_matrix(cpool, feats, fname), n)
+    return out
+
+
+def prepare_device_query(dev: Dict[str, Any]) -> Dict[str, Any]:
+    """预计算设备请求侧的查询字段（每个设备只计算一次）"""
     # 提取查询字段
     floor_q = get_primary_field(dev, 'floor')
     room_q = get_primary_field(dev, 'room')
@@ -323,17 +642,6 @@ def compute_scores_for_device(dev: Dict[str, Any],
     if not type_q and dev.get('service'):
         type_q = str(dev['service']).split('.')[0]
     
-    # 提取实体字段
-    e_floor_cands = extract_field_candidates(e, 'floor')
-    e_room_cands = extract_field_candidates(e, 'room')
-    e_name_cands = extract_field_candidates(e, 'name')
-    e_type_cands = extract_field_candidates(e, 'type')
-    
-    # 计算相似度
-    floor_score = field_similarity(floor_q, e_floor_cands) if floor_q else 0.0
-    room_score = field_similarity(room_q, e_room_cands) if room_q else 0.0
-    name_score = field_similarity(name_q, e_name_cands) if name_q else 0.0
-    
     # ⭐ 优化：更精确的设备类型匹配
     # 如果 name_q 包含类型信息（如"温度传感器"），提取类型
     if name_q and not type_q:
@@ -344,30 +652,71 @@ def compute_scores_for_device(dev: Dict[str, Any],
         elif 'humidity' in name_norm or 'shidu' in name_norm or '湿度' in name_q:
             type_q = 'humidity'
     
-    # 类型相似度（使用别名扩展）
-    type_cands = []
-    if type_q:
-        type_cands = expand_alias_fast(type_q, 'device_types')
-    e_types_norm = []
-    for c in e_type_cands:
-        e_types_norm.extend(expand_alias_fast(c, 'device_types'))
-    type_score = field_similarity(
-        ' '.join(type_cands) if type_cands else type_q,
-        [' '.join(e_types_norm)] if e_types_norm else e_type_cands
-    )
+    # 类型查询（使用别名扩展）
+    type_cands = expand_alias_fast(type_q, 'device_types') if type_q else []
+    
+    # 位置提取
+    extracted_room = ''
+    if name_q:
+        extracted_room = normalize(detect_location_from_name(name_q, _location_matcher))
+    
+    return {
+        'floor_q': floor_q,
+        'room_q': room_q,
+        'name_q': name_q,
+        'type_q': type_q,
+        'floor_norm': normalize(floor_q),
+        'room_norm': normalize(room_q),
+        'name_norm': normalize(name_q),
+        'type_norm': normalize(' '.join(type_cands) if type_cands else type_q),
+        'extracted_room': extracted_room,
+        'is_generic': normalize(name_q) in GENERIC_NAMES if name_q else False
+    }
+
+
+# ============ 核心评分函数 ============
+def compute_scores_for_device(dev_q: Dict[str, Any], 
+                              ent_idx: int, 
+                              feats: EntityFeatureTable, 
+                              cfg: Dict[str, Any],
+                              field_sims: Optional[Dict[str, np.ndarray]] = None) -> Tuple[float, Dict[str, Any]]:
+    """计算设备匹配得分（dev_q 来自 prepare_device_query，实体特征通过下标从 feats 读取）
+    
+    field_sims 为 bulk_field_scores 的批量结果，提供时直接按下标读取相似度。
+    """
+    
+    floor_q = dev_q['floor_q']
+    room_q = dev_q['room_q']
+    name_q = dev_q['name_q']
+    type_q = dev_q['type_q']
+    is_generic = dev_q['is_generic']
+    
+    # 泛指名称（如"灯"）不参与阈值与排序，名称相似度只在实体通过阈值后为证据计算
+    score_name = bool(name_q) and not is_generic
+    
+    # 计算相似度
+    ef = feats[ent_idx]
+    if field_sims is not None:
+        floor_score = float(field_sims['floor'][ent_idx]) if floor_q else 0.0
+        room_score = float(field_sims['room'][ent_idx]) if room_q else 0.0
+        name_score = float(field_sims['name'][ent_idx]) if score_name else 0.0
+        type_score = float(field_sims['type'][ent_idx])
+    else:
+        floor_score = normalized_similarity(dev_q['floor_norm'], ef.floor) if floor_q else 0.0
+        room_score = normalized_similarity(dev_q['room_norm'], ef.room) if room_q else 0.0
+        name_score = normalized_similarity(dev_q['name_norm'], ef.name) if score_name else 0.0
+        
+        # 类型相似度（使用别名扩展）
+        type_score = normalized_similarity(dev_q['type_norm'], ef.type)
     
     # 位置提取奖励
     location_bonus = 0.0
-    if name_q:
-        extracted_room = detect_location_from_name(name_q, aliases.get('rooms', {}))
-        if extracted_room:
-            entity_room_norm = normalize(get_primary_field(e, 'room'))
-            if normalize(extracted_room) and (normalize(extracted_room) == entity_room_norm):
-                location_bonus = 0.4
+    extracted_room = dev_q['extracted_room']
+    if extracted_room and extracted_room == ef.room_primary:
+        location_bonus = 0.4
     
     # 阈值检查
-    TH = cfg.get('thresholds', {'floor': 0.7, 'room': 0.7, 'type': 0.65, 'name': 0.8})
-    is_generic = normalize(name_q) in GENERIC_NAMES if name_q else False
+    TH = cfg.get('thresholds', DEFAULT_THRESHOLDS)
     
     # ⭐ 房间匹配优化：精确匹配或完全包含
     floor_pass = True if not floor_q else (floor_score >= TH.get('floor', 0.7))
@@ -390,8 +739,11 @@ def compute_scores_for_device(dev: Dict[str, Any],
             'device_type': {'text': type_q, 'score': type_score}
         }
     
+    if name_q and is_generic:
+        name_score = normalized_similarity(dev_q['name_norm'], ef.name)
+    
     # 加权得分
-    W = cfg.get('weights', {'F': 0.15, 'R': 0.40, 'N': 0.30, 'T': 0.15})
+    W = cfg.get('weights', DEFAULT_WEIGHTS)
     name_score_final = (0.85 if is_generic else name_score)
     floor_score_weight = (floor_score if floor_q else 0.90)
     base = (W['F'] * floor_score_weight + 
@@ -408,10 +760,18 @@ def compute_scores_for_device(dev: Dict[str, Any],
     }
 
 
+def select_top(items: List[Dict[str, Any]], k: int, key) -> List[Dict[str, Any]]:
+    """按 key 降序取前 k 项（同分保持原顺序，与稳定排序后切片一致）"""
+    if 0 <= k < len(items):
+        return heapq.nlargest(k, items, key=key)
+    return sorted(items, key=key, reverse=True)[:k]
+
+
 def loose_suggestions(dev: Dict[str, Any], 
-                     pool: List[Dict[str, Any]], 
-                     cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
-    """生成宽松建议 - 只在目标位置查找"""
+                     cpool: CandidatePool, 
+                     cfg: Dict[str, Any],
+                     feats: EntityFeatureTable) -> List[Dict[str, Any]]:
+    """生成宽松建议 - 只在目标位置查找（实体字段读取 feats 中的预计算结果）"""
     
     # 获取查询的楼层和房间
     request_floor = get_primary_field(dev, 'floor')
@@ -428,7 +788,8 @@ def loose_suggestions(dev: Dict[str, Any],
     
     # 只在指定位置查找建议
     filtered_pool = []
-    for e in pool:
+    idx = []
+    for e, i in zip(cpool.entities, cpool.idx):
         e_floor = get_primary_field(e, 'floor')
         e_room = get_primary_field(e, 'room')
         
@@ -455,60 +816,174 @@ def loose_suggestions(dev: Dict[str, Any],
                     continue
         
         filtered_pool.append(e)
+        idx.append(i)
     
     # 如果指定位置没有任何实体，返回空列表（不跨位置建议）
     if request_floor_norm and not filtered_pool:
         return []
     
-    # 使用过滤后的池生成建议
-    items = []
-    for e in filtered_pool:
-        e_floor = extract_field_candidates(e, 'floor')
-        e_room = extract_field_candidates(e, 'room')
-        e_name = extract_field_candidates(e, 'name')
-        e_type = extract_field_candidates(e, 'type')
+    # 设备侧查询只规范化一次
+    floor_q = normalize(request_floor)
+    room_q = normalize(request_room)
+    name_q = normalize(get_primary_field(dev, 'name'))
+    type_q = normalize(get_primary_field(dev, 'type'))
+    
+    # 使用过滤后的池生成建议（类型使用未做别名扩展的候选）
+    if len(idx) >= BULK_MIN_POOL:
+        # 大候选池：四个字段一次批量计算，再合成加权得分向量
+        n = len(feats.entities)
+        sel = np.asarray(idx, dtype=np.intp)
+        
+        def col(fname, q):
+            return bulk_similarity(q, field_matrix(cpool, feats, fname), n)[sel]
         
-        s = (0.15 * field_similarity(get_primary_field(dev, 'floor'), e_floor) +
-             0.40 * field_similarity(get_primary_field(dev, 'room'), e_room) +
-             0.30 * field_similarity(get_primary_field(dev, 'name'), e_name) +
-             0.15 * field_similarity(get_primary_field(dev, 'type'), e_type))
-        items.append({'e': e, 's': float(s)})
+        scores = (0.15 * col('floor', floor_q) +
+                  0.40 * col('room', room_q) +
+                  0.30 * col('name', name_q) +
+                  0.15 * col('raw_type', type_q)).tolist()
+    else:
+        scores = [
+            0.15 * normalized_similarity(floor_q, feats[i].floor) +
+            0.40 * normalized_similarity(room_q, feats[i].room) +
+            0.30 * normalized_similarity(name_q, feats[i].name) +
+            0.15 * normalized_similarity(type_q, feats[i].raw_type)
+            for i in idx
+        ]
+    items = [{'e': e, 's': float(s)} for e, s in zip(filtered_pool, scores)]
     
-    items.sort(key=lambda x: x['s'], reverse=True)
+    items = select_top(items, 3, key=lambda x: x['s'])
     return [{
         'entity_id': it['e'].get('entity_id', ''),
         'device_name': get_primary_field(it['e'], 'name'),
         'room': get_primary_field(it['e'], 'room'),
         'floor': get_primary_field(it['e'], 'floor'),
         'reason_score': round(it['s'], 3)
-    } for it in items[:3]]
+    } for it in items]
 
 
 def build_type_index(entities: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
-    """构建类型索引"""
+    """构建类型索引（每个类型下同一实体对象只出现一次）"""
     index = {}
+    seen = {}  # 类型 -> 已加入实体的 id 集合，O(1) 去重
+    
+    def add(key: str, e: Dict[str, Any]) -> None:
+        ids = seen.setdefault(key, set())
+        if id(e) in ids:
+            return
+        ids.add(id(e))
+        index.setdefault(key, []).append(e)
+    
     for e in entities:
         domain = (str(e.get('entity_id', '')).split('.')[0] 
                  if e.get('entity_id') else '')
-        if domain:
-            domain_normalized = normalize(domain)
-            if domain_normalized:
-                if domain_normalized not in index:
-                    index[domain_normalized] = []
-                index[domain_normalized].append(e)
+        domain_normalized = normalize(domain)
+        if domain_normalized:
+            add(domain_normalized, e)
         
         device_type = e.get('device_type', '')
         if device_type:
             type_normalized = normalize(device_type)
-            if type_normalized and type_normalized != normalize(domain):
-                if type_normalized not in index:
-                    index[type_normalized] = []
-                if e not in index.get(type_normalized, []):
-                    index[type_normalized].append(e)
+            if type_normalized and type_normalized != domain_normalized:
+                add(type_normalized, e)
     
     return index
 
 
+def _score_one_device(dev: Dict[str, Any],
+                      entities: List[Dict[str, Any]],
+                      type_index: Dict[str, List],
+                      feats: EntityFeatureTable,
+                      pool_cache: Dict[Tuple, CandidatePool],
+                      cfg: Dict[str, Any],
+                      topK: int,
+                      gap: float) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """对单个意图设备评分，返回 (匹配设备列表, action)"""
+    floor_q = get_primary_field(dev, 'floor')
+    room_q = get_primary_field(dev, 'room')
+    name_q = get_primary_field(dev, 'name')
+    type_q = get_primary_field(dev, 'type')
+    service_domain = str(dev['service']).split('.')[0] if dev.get('service') else ''
+    
+    # 使用智能过滤获取候选池
+    pool_key = (normalize(type_q), normalize(room_q), normalize(floor_q), normalize(service_domain))
+    cpool = pool_cache.get(pool_key)
+    if cpool is None:
+        pool = filter_candidates(dev, entities, type_index)
+        cpool = pool_cache[pool_key] = CandidatePool(pool, [feats.index_of[id(e)] for e in pool])
+    pool = cpool.entities
+    
+    # 设备侧查询字段只计算一次
+    dev_q = prepare_device_query(dev)
+    
+    # 名称倒排索引剪枝：跳过与查询名称无共同 n-gram 的实体（建议仍使用完整候选池）
+    cand = candidate_set_for_device(dev_q, cpool, feats, cfg)
+    
+    # 大候选池：四个字段的相似度用 numpy 一次算完
+    field_sims = None
+    n_scored = len(pool) if cand is None else sum(1 for i in cpool.idx if i in cand)
+    if n_scored >= BULK_MIN_POOL:
+        field_sims = bulk_field_scores(dev_q, cpool, feats)
+    
+    scored = []
+    for e, ent_idx in zip(pool, cpool.idx):
+        if cand is not None and ent_idx not in cand:
+            continue
+        s, ev = compute_scores_for_device(dev_q, ent_idx, feats, cfg, field_sims)
+        if s >= 0:
+            scored.append({'e': e, 'score': s, 'ev': ev})
+    
+    top = select_top(scored, topK, key=lambda x: x['score'])
+    
+    # 生成建议（当没有匹配时）
+    suggestions = []
+    if not top:
+        suggestions = loose_suggestions(dev, cpool, cfg, feats)
+    
+    # 将匹配的设备添加到输出
+    # ⭐ 只添加真正匹配的设备，不自动应用建议
+    matched_devices = []
+    if top:
+        for it in top:
+            matched_device = {
+                'entity_id': it['e'].get('entity_id', ''),
+                'service': dev.get('service') or None,
+                'service_data': dev.get('service_data') or {}
+            }
+            # ⭐ 如果设备有 automation 字段，添加到 matched_device
+            if 'automation' in dev:
+                matched_device['automation'] = dev['automation']
+            matched_devices.append(matched_device)
+    
+    action = {
+        'request': {
+            'floor': floor_q or None,
+            'room': room_q or None,
+            'device_name': name_q or None,
+            'device_type': type_q or None,
+            'service': dev.get('service') or None,
+            'service_data': dev.get('service_data') or {}
+        },
+        'targets': [{
+            'entity_id': it['e'].get('entity_id', ''),
+            'device_type': (it['e'].get('device_type', '') or '').lower(),
+            'device_name': get_primary_field(it['e'], 'name'),
+            'floor': get_primary_field(it['e'], 'floor'),
+            'room': get_primary_field(it['e'], 'room'),
+            'score': round(float(it['score']), 3),
+            'matched': it['ev']
+        } for it in top],
+        'disambiguation_required': (len(top) >= 2 and 
+                                   (top[0]['score'] - top[1]['score']) < gap),
+        'warnings': [],
+        'suggestions_if_empty': suggestions
+    }
+    # ⭐ 如果设备有 automation 字段，添加到 action.request
+    if 'automation' in dev:
+        action['request']['automation'] = dev['automation']
+    return matched_devices, action
+
+
+
 # ============ 优化 9: 输入验证 ============
 def validate_input(payload: Dict[str, Any]) -> Tuple[bool, str]:
     """验证输入数据 - 支持新旧格式"""
@@ -629,17 +1104,24 @@ def process(payload: Dict[str, Any]) -> Dict[str, Any]:
         aliases = payload.get('aliases') or {}
         cfg = payload.get('config') or {}
     
-    # 初始化别名反向索引（一次性计算）
-    global _alias_indices
-    _alias_indices = {
-        'rooms': build_alias_reverse_index(aliases.get('rooms', {})),
-        'floors': build_alias_reverse_index(aliases.get('floors', {})),
-        'device_types': build_alias_reverse_index(aliases.get('device_types', {}))
-    }
+    # 初始化别名反向索引（别名未变化时复用上一次请求的结果）
+    global _alias_indices, _alias_fingerprint, _location_matcher
+    fingerprint = aliases_fingerprint(aliases)
+    if fingerprint != _alias_fingerprint:
+        _alias_indices = {
+            'rooms': build_alias_reverse_index(aliases.get('rooms', {})),
+            'floors': build_alias_reverse_index(aliases.get('floors', {})),
+            'device_types': build_alias_reverse_index(aliases.get('device_types', {}))
+        }
+        _location_matcher = build_location_matcher(aliases.get('rooms', {}))
+        _alias_fingerprint = fingerprint
     
     # 构建类型索引
     type_index = build_type_index(entities)
     
+    # 实体特征按需计算（只计算进入候选池的实体，所有设备复用）
+    feats = EntityFeatureTable(entities)
+    
     out = {
         'intent': intent_name,  # ⭐ 使用提取的 intent
         'user_input': user_query,
@@ -650,69 +1132,45 @@ def process(payload: Dict[str, Any]) -> Dict[str, Any]:
     topK = int(cfg.get('topK', 100))
     gap = float(cfg.get('disambiguationGap', 0.08))
     
+    # 候选池缓存（请求内有效）：过滤结果只取决于规范化后的类型/房间/楼层/服务域
+    pool_cache = {}
+    
     for dev in intent_devices:
-        # 使用智能过滤获取候选池
-        pool = filter_candidates(dev, entities, type_index)
-        
-        scored = []
-        for e in pool:
-            s, ev = compute_scores_for_device(dev, e, aliases, cfg)
-            if s >= 0:
-                scored.append({'e': e, 'score': s, 'ev': ev})
-        
-        scored.sort(key=lambda x: x['score'], reverse=True)
-        top = scored[:topK]
-        
-        # 生成建议（当没有匹配时）
-        suggestions = []
-        if not top:
-            suggestions = loose_suggestions(dev, pool, cfg)
-        
-        # 将匹配的设备添加到输出
-        # ⭐ 只添加真正匹配的设备，不自动应用建议
-        if top:
-            for it in top:
-                matched_device = {
-                    'entity_id': it['e'].get('entity_id', ''),
-                    'service': dev.get('service') or None,
-                    'service_data': dev.get('service_data') or {}
-                }
-                # ⭐ 如果设备有 automation 字段，添加到 matched_device
-                if 'automation' in dev:
-                    matched_device['automation'] = dev['automation']
-                out['matched_devices'].append(matched_device)
-        
-        action = {
-            'request': {
-                'floor': get_primary_field(dev, 'floor') or None,
-                'room': get_primary_field(dev, 'room') or None,
-                'device_name': get_primary_field(dev, 'name') or None,
-                'device_type': get_primary_field(dev, 'type') or None,
-                'service': dev.get('service') or None,
-                'service_data': dev.get('service_data') or {}
-            },
-            'targets': [{
-                'entity_id': it['e'].get('entity_id', ''),
-                'device_type': (it['e'].get('device_type', '') or '').lower(),
-                'device_name': get_primary_field(it['e'], 'name'),
-                'floor': get_primary_field(it['e'], 'floor'),
-                'room': get_primary_field(it['e'], 'room'),
-                'score': round(float(it['score']), 3),
-                'matched': it['ev']
-            } for it in top],
-            'disambiguation_required': (len(top) >= 2 and 
-                                       (top[0]['score'] - top[1]['score']) < gap),
-            'warnings': [],
-            'suggestions_if_empty': suggestions
-        }
-        # ⭐ 如果设备有 automation 字段，添加到 action.request
-        if 'automation' in dev:
-            action['request']['automation'] = dev['automation']
+        matched_devices, action = _score_one_device(dev, entities, type_index, feats, pool_cache, cfg, topK, gap)
+        out['matched_devices'].extend(matched_devices)
         out['actions'].append(action)
     
     return out
 
 
+# ============ JSON 输入输出 ============
+def loads_payload(raw: str) -> Any:
+    """解析请求 JSON：orjson 可用时优先使用，失败时回退到标准库
+    
+    orjson 不接受的输入（如 NaN、超长整数）由标准库解析；两者都失败时抛出标准库的
+    json.JSONDecodeError，错误信息和 lineno/colno 与原实现一致。
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
+
+
+def emit(obj: Any) -> None:
+    """输出一行 JSON 并刷新 stdout"""
+    if orjson is not None:
+        try:
+            sys.stdout.buffer.write(orjson.dumps(obj) + b'\n')
+            sys.stdout.buffer.flush()
+            return
+        except TypeError:
+            pass  # orjson 不支持的类型交给标准库
+    sys.stdout.write(json.dumps(obj, ensure_ascii=False) + '\n')
+    sys.stdout.flush()
+
+
 def main():
     """主入口函数"""
     import argparse
@@ -731,31 +1189,25 @@ def main():
                 if not line:
                     continue
                 try:
-                    payload = json.loads(line)
+                    payload = loads_payload(line)
                 except json.JSONDecodeError as e:
-                    print(json.dumps({
-                        'error': f'Invalid JSON: {str(e)}'
-                    }))
-                    sys.stdout.flush()
+                    emit({'error': f'Invalid JSON: {str(e)}'})
                     continue
 
                 valid, error_msg = validate_input(payload)
                 if not valid:
-                    print(json.dumps({'error': error_msg}))
-                    sys.stdout.flush()
+                    emit({'error': error_msg})
                     continue
 
                 try:
                     result = process(payload)
-                    print(json.dumps(result, ensure_ascii=False))
                 except Exception as e:
                     import traceback
-                    print(json.dumps({
+                    result = {
                         'error': str(e),
                         'traceback': traceback.format_exc()
-                    }))
-                finally:
-                    sys.stdout.flush()
+                    }
+                emit(result)
         except KeyboardInterrupt:
             return
         return
@@ -763,30 +1215,30 @@ def main():
     # 一次性模式：读取整个 stdin
     raw = sys.stdin.read()
     try:
-        payload = json.loads(raw)
+        payload = loads_payload(raw)
     except json.JSONDecodeError as e:
-        print(json.dumps({
+        emit({
             'error': f'Invalid JSON: {str(e)}',
             'line': e.lineno,
             'column': e.colno
-        }))
+        })
         return
 
     valid, error_msg = validate_input(payload)
     if not valid:
-        print(json.dumps({'error': error_msg}))
+        emit({'error': error_msg})
         return
 
     try:
         result = process(payload)
-        print(json.dumps(result, ensure_ascii=False))
     except Exception as e:
         import traceback
-        print(json.dumps({
+        result = {
             'error': str(e),
             'traceback': traceback.format_exc()
-        }))
+        }
+    emit(result)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()